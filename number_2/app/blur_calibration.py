@@ -0,0 +1,319 @@
+"""
+Adaptive blur threshold calibration from labelled variance scores
+"""
+import json
+import math
+import os
+import re
+import threading
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CALIBRATION_FILE = os.getenv("BLUR_CALIBRATION_FILE", "/app/output/blur_calibration.json")
+DEFAULT_THRESHOLD = float(os.getenv("BLUR_THRESHOLD", "500.0"))
+MIN_LABELS = int(os.getenv("BLUR_CALIBRATION_MIN_LABELS", "5"))
+MIN_SAMPLES = int(os.getenv("BLUR_CALIBRATION_MIN_SAMPLES", "20"))
+MAX_SOURCES = int(os.getenv("BLUR_CALIBRATION_MAX_SOURCES", "50"))
+REFRESH_EVERY = int(os.getenv("BLUR_CALIBRATION_REFRESH_EVERY", "10"))
+
+# Optional cap: a threshold may not rise above this quantile of a bucket's
+# scores once it has MIN_SAMPLES. 1.0 disables the cap.
+MAX_REJECT_QUANTILE = float(os.getenv("BLUR_CALIBRATION_MAX_REJECT_QUANTILE", "1.0"))
+
+# Calibrated thresholds stay within [default / MAX_SCALE, default * MAX_SCALE]
+MAX_SCALE = 4.0
+
+# Upper bounds of sky brightness (0-255) per bucket, e.g. "night:125,day:256".
+# Night shots in image_dataset measure 20-102, daylight shots 148-182.
+BRIGHTNESS_BUCKETS = [
+    (float(upper), name)
+    for name, upper in (
+        item.split(":") for item in os.getenv("BLUR_BRIGHTNESS_BUCKETS", "night:125,day:256").split(",")
+    )
+]
+
+LABELS = ("blur", "sharp")
+
+SOURCE_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$")
+
+
+def brightness_bucket(brightness: float) -> str:
+    """Map mean gray intensity to a brightness bucket name"""
+    for upper, name in BRIGHTNESS_BUCKETS:
+        if brightness < upper:
+            return name
+    return BRIGHTNESS_BUCKETS[-1][1]
+
+
+def validate_source(source: str) -> str:
+    """Return source if it is a plain identifier such as a hostname"""
+    if not SOURCE_PATTERN.match(source):
+        raise ValueError(f"Invalid source: {source!r}")
+    return source
+
+
+class QuantileSketch:
+    """
+    Streaming quantile sketch with log-spaced bins.
+    Every quantile is within `relative_accuracy` of the true value and
+    memory depends on the score range, not on the number of samples.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.05):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.count = 0
+
+    def _index(self, value: float) -> int:
+        if value <= 1.0:
+            return 0
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, index: int) -> float:
+        if index <= 0:
+            return 1.0
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value: float) -> None:
+        index = self._index(value)
+        self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen >= rank:
+                return self._value(index)
+        return self._value(max(self.bins))
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "bins": {str(k): v for k, v in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QuantileSketch":
+        sketch = cls(data.get("relative_accuracy", 0.05))
+        sketch.bins = {int(k): int(v) for k, v in data.get("bins", {}).items()}
+        sketch.count = sum(sketch.bins.values())
+        return sketch
+
+
+class BucketStats:
+    """Score sketches for one brightness bucket: all scores plus one per label"""
+
+    def __init__(self):
+        self.scores = QuantileSketch()
+        self.labels = {label: QuantileSketch() for label in LABELS}
+
+    def cut_point(
+        self,
+        default: float,
+        min_labels: int,
+        min_samples: int,
+        max_reject_quantile: float = MAX_REJECT_QUANTILE,
+    ) -> Optional[float]:
+        """
+        Threshold halfway between the top of the blur scores and the bottom
+        of the sharp scores, or None until both labels have enough samples.
+        """
+        blur, sharp = self.labels["blur"], self.labels["sharp"]
+        if blur.count < min_labels or sharp.count < min_labels:
+            return None
+
+        cut = (blur.quantile(0.9) + sharp.quantile(0.1)) / 2
+        if max_reject_quantile < 1.0 and self.scores.count >= min_samples:
+            cut = min(cut, self.scores.quantile(max_reject_quantile))
+        return min(max(cut, default / MAX_SCALE), default * MAX_SCALE)
+
+    def to_dict(self) -> dict:
+        return {
+            "scores": self.scores.to_dict(),
+            "labels": {k: v.to_dict() for k, v in self.labels.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BucketStats":
+        stats = cls()
+        stats.scores = QuantileSketch.from_dict(data.get("scores", {}))
+        for label in LABELS:
+            stats.labels[label] = QuantileSketch.from_dict(data.get("labels", {}).get(label, {}))
+        return stats
+
+
+class BlurCalibrator:
+    """
+    Derives blur thresholds per brightness bucket, and per source within
+    a bucket, from variance scores of manually labelled images.
+
+    Labelled images set the cut-point, which may move above or below the
+    default. Every analyzed image adds its score to the bucket's distribution,
+    which can optionally cap the threshold at a low quantile of those scores.
+    Without labels the default threshold applies. Thresholds are looked up
+    from dicts at request time.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = CALIBRATION_FILE,
+        default_threshold: float = DEFAULT_THRESHOLD,
+        min_labels: int = MIN_LABELS,
+        min_samples: int = MIN_SAMPLES,
+        max_reject_quantile: float = MAX_REJECT_QUANTILE,
+        max_sources: int = MAX_SOURCES,
+        refresh_every: int = REFRESH_EVERY,
+    ):
+        self.path = path
+        self.default_threshold = default_threshold
+        self.min_labels = min_labels
+        self.min_samples = min_samples
+        self.max_reject_quantile = max_reject_quantile
+        self.max_sources = max_sources
+        self.refresh_every = refresh_every
+        self.buckets: Dict[str, BucketStats] = {}
+        self.sources: Dict[str, Dict[str, BucketStats]] = {}
+        self.bucket_thresholds: Dict[str, float] = {}
+        self.source_thresholds: Dict[Tuple[str, str], float] = {}
+        self._pending = 0
+        self._version = 0
+        self._written_version = 0
+        self._write_lock = threading.Lock()
+        self.load()
+
+    def threshold(self, source: str, brightness: float) -> float:
+        """Calibrated threshold for this source, falling back to bucket then default"""
+        return self.threshold_for_bucket(source, brightness_bucket(brightness))
+
+    def threshold_for_bucket(self, source: Optional[str], bucket: str) -> float:
+        threshold = self.source_thresholds.get((source, bucket))
+        if threshold is None:
+            threshold = self.bucket_thresholds.get(bucket, self.default_threshold)
+        return threshold
+
+    def _stats(self, source: str, bucket: str) -> List[BucketStats]:
+        validate_source(source)
+        stats = [self.buckets.setdefault(bucket, BucketStats())]
+        if source in self.sources or len(self.sources) < self.max_sources:
+            stats.append(self.sources.setdefault(source, {}).setdefault(bucket, BucketStats()))
+        return stats
+
+    def record(self, source: str, brightness: float, variance: float) -> bool:
+        """
+        Record the score of an analyzed image.
+        Returns True when thresholds were refreshed and should be saved.
+        """
+        for stats in self._stats(source, brightness_bucket(brightness)):
+            stats.scores.add(variance)
+
+        self._pending += 1
+        if self._pending >= self.refresh_every:
+            self.refresh()
+            return True
+        return False
+
+    def label(self, source: str, brightness: float, variance: float, label: str) -> None:
+        """Record a manual blur/sharp label for an image's score"""
+        if label not in LABELS:
+            raise ValueError(f"Label must be one of {', '.join(LABELS)}")
+        for stats in self._stats(source, brightness_bucket(brightness)):
+            stats.labels[label].add(variance)
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Recompute all thresholds from the current score distributions"""
+        self._pending = 0
+        args = (self.default_threshold, self.min_labels, self.min_samples, self.max_reject_quantile)
+
+        bucket_thresholds = {}
+        for bucket, stats in self.buckets.items():
+            cut = stats.cut_point(*args)
+            if cut is not None:
+                bucket_thresholds[bucket] = cut
+
+        source_thresholds = {}
+        for source, buckets in self.sources.items():
+            for bucket, stats in buckets.items():
+                cut = stats.cut_point(*args)
+                if cut is not None:
+                    source_thresholds[(source, bucket)] = cut
+
+        self.bucket_thresholds = bucket_thresholds
+        self.source_thresholds = source_thresholds
+
+    def stats(self) -> List[dict]:
+        """Per-bucket sample and label counts with the threshold in use"""
+        rows = []
+        entries = [(None, bucket, stats) for bucket, stats in self.buckets.items()]
+        for source, buckets in self.sources.items():
+            entries.extend((source, bucket, stats) for bucket, stats in buckets.items())
+
+        for source, bucket, stats in entries:
+            rows.append({
+                "source": source,
+                "bucket": bucket,
+                "samples": stats.scores.count,
+                "labels": {k: v.count for k, v in stats.labels.items()},
+                "threshold": self.threshold_for_bucket(source, bucket),
+            })
+        return rows
+
+    def snapshot(self) -> dict:
+        """Serializable copy of the recorded data, safe to write from another thread"""
+        self._version += 1
+        return {
+            "version": self._version,
+            "buckets": {k: v.to_dict() for k, v in self.buckets.items()},
+            "sources": {
+                source: {k: v.to_dict() for k, v in buckets.items()}
+                for source, buckets in self.sources.items()
+            },
+        }
+
+    def load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            buckets = {k: BucketStats.from_dict(v) for k, v in data.get("buckets", {}).items()}
+            sources = {
+                source: {k: BucketStats.from_dict(v) for k, v in source_buckets.items()}
+                for source, source_buckets in data.get("sources", {}).items()
+            }
+        except (OSError, AttributeError, TypeError, ValueError) as e:
+            logger.warning(f"Cannot load blur calibration, starting empty: {e}")
+            return
+
+        self.buckets = buckets
+        self.sources = sources
+        self.refresh()
+
+    def write(self, data: dict) -> None:
+        """Write a snapshot to the calibration file (blocking), skipping stale ones"""
+        if not self.path:
+            return
+        with self._write_lock:
+            if data["version"] <= self._written_version:
+                return
+            try:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, separators=(",", ":"))
+                os.replace(tmp_path, self.path)
+                self._written_version = data["version"]
+            except OSError as e:
+                logger.warning(f"Cannot save blur calibration: {e}")
+
+    def save(self) -> None:
+        self.write(self.snapshot())
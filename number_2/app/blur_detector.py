@@ -6,11 +6,12 @@ import numpy as np
 from typing import Tuple
 
 
-def is_blur(image_bytes: bytes, threshold: float = 500.0) -> Tuple[bool, float]:
+def measure_image(image_bytes: bytes) -> Tuple[float, float]:
     """
-    Detect if image is blurry using edge detection.
-    Lower variance = more blur.
-    Returns (is_blurry, variance_score)
+    Compute Laplacian variance and brightness (0-255).
+    Brightness is the mean of the top third of the frame, where the sky
+    separates night from daylight better than the whole-frame mean.
+    Returns (variance_score, brightness)
     """
     nparr = np.frombuffer(image_bytes, np.uint8)
     image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
@@ -28,18 +29,31 @@ def is_blur(image_bytes: bytes, threshold: float = 500.0) -> Tuple[bool, float]:
     laplacian = cv2.Laplacian(gray, cv2.CV_64F)
     variance = laplacian.var()
     
+    brightness = gray[:max(1, gray.shape[0] // 3)].mean()
+    
+    return float(variance), float(brightness)
+
+
+def is_blur(image_bytes: bytes, threshold: float = 500.0) -> Tuple[bool, float]:
+    """
+    Detect if image is blurry using edge detection.
+    Lower variance = more blur.
+    Returns (is_blurry, variance_score)
+    """
+    variance, _ = measure_image(image_bytes)
     return variance < threshold, variance
 
 
-def get_blur_level(variance: float) -> str:
-    """Categorize blur level based on variance"""
-    if variance < 50:
+def get_blur_level(variance: float, threshold: float = 500.0) -> str:
+    """Categorize blur level based on variance, scaled to the blur threshold"""
+    scale = threshold / 500.0
+    if variance < 50 * scale:
         return "very_blurry"
-    elif variance < 100:
+    elif variance < 100 * scale:
         return "blurry"
-    elif variance < 200:
+    elif variance < 200 * scale:
         return "slightly_blurry"
-    elif variance < 500:
+    elif variance < threshold:
         return "sharp"
     else:
         return "very_sharp"
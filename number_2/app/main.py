@@ -3,61 +3,101 @@ Image Blur Detection API
 FastAPI service for analyzing images
 """
 import base64
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+from urllib.parse import urlparse
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from pydantic import BaseModel
 import httpx
 import logging
 
-from .blur_detector import is_blur
+from .blur_calibration import BlurCalibrator, validate_source
+from .blur_detector import get_blur_level, measure_image
 from .openai_service import describe_image_base64
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+calibrator = BlurCalibrator()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    calibrator.save()
+
+
 app = FastAPI(
     title="Lion Parcel Image API",
     description="Blur detection and image description service",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 
 class ImageRequest(BaseModel):
     image_url: str
+    source: Optional[str] = None
 
 
 class ImageResponse(BaseModel):
     result: str
 
 
+class LabelRequest(BaseModel):
+    image_url: str
+    label: Literal["blur", "sharp"]
+    source: Optional[str] = None
+
+
+def get_source(request) -> str:
+    """Camera/source id from the request, defaulting to the image host"""
+    source = request.source or urlparse(request.image_url).hostname or "unknown"
+    return validate_source(source)
+
+
+async def fetch_image(image_url: str) -> httpx.Response:
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        response = await client.get(image_url)
+    
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail=f"Failed to fetch image: HTTP {response.status_code}")
+    
+    return response
+
+
 @app.get("/")
 async def root():
     return {"status": "healthy", "service": "Image API"}
 
 
 @app.post("/analyze", response_model=ImageResponse)
-async def analyze_image(request: ImageRequest):
+async def analyze_image(request: ImageRequest, background_tasks: BackgroundTasks):
     """
     Check if image is blurry. If not, describe it using OpenAI.
     """
     logger.info(f"Analyzing: {request.image_url}")
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(request.image_url)
-            
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"Failed to fetch image: HTTP {response.status_code}")
-            
-            image_bytes = response.content
+        source = get_source(request)
+        response = await fetch_image(request.image_url)
+        image_bytes = response.content
         
         content_type = response.headers.get("content-type", "image/jpeg")
         if not content_type.startswith("image/"):
             content_type = "image/jpeg"
         
-        blur_detected, blur_score = is_blur(image_bytes)
-        logger.info(f"Blur score: {blur_score:.2f}")
+        blur_score, brightness = measure_image(image_bytes)
+        threshold = calibrator.threshold(source, brightness)
+        logger.info(
+            f"Blur score: {blur_score:.2f} ({get_blur_level(blur_score, threshold)}), "
+            f"brightness: {brightness:.1f}, threshold: {threshold:.2f}"
+        )
+        
+        if calibrator.record(source, brightness, blur_score):
+            background_tasks.add_task(calibrator.write, calibrator.snapshot())
         
-        if blur_detected:
+        if blur_score < threshold:
             return ImageResponse(result="blur")
         
         image_base64 = base64.b64encode(image_bytes).decode('utf-8')
@@ -72,11 +112,45 @@ async def analyze_image(request: ImageRequest):
     except ValueError as e:
         logger.error(f"Processing error: {e}")
         raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/calibration/label")
+async def label_image(request: LabelRequest, background_tasks: BackgroundTasks):
+    """
+    Label an image as blur or sharp to calibrate the threshold for its source.
+    """
+    try:
+        source = get_source(request)
+        response = await fetch_image(request.image_url)
+        blur_score, brightness = measure_image(response.content)
+        calibrator.label(source, brightness, blur_score, request.label)
+    except httpx.RequestError as e:
+        logger.error(f"Network error: {e}")
+        raise HTTPException(status_code=500, detail=f"Network error: {str(e)}")
+    except ValueError as e:
+        logger.error(f"Label error: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    background_tasks.add_task(calibrator.write, calibrator.snapshot())
+    
+    return {
+        "source": source,
+        "blur_score": blur_score,
+        "brightness": brightness,
+        "threshold": calibrator.threshold(source, brightness),
+    }
+
+
+@app.get("/calibration")
+async def calibration_stats():
+    return {"default_threshold": calibrator.default_threshold, "buckets": calibrator.stats()}
+
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
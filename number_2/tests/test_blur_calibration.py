@@ -0,0 +1,162 @@
+import json
+import random
+
+import pytest
+
+from app.blur_calibration import BlurCalibrator, QuantileSketch
+
+
+def make_calibrator(**kwargs):
+    options = dict(path=None, default_threshold=500.0, min_labels=3, min_samples=20, refresh_every=10)
+    options.update(kwargs)
+    return BlurCalibrator(**options)
+
+
+def label_many(calibrator, source, brightness, scores, label):
+    for score in scores:
+        calibrator.label(source, brightness, score, label)
+
+
+def test_sketch_quantiles_within_relative_accuracy():
+    rng = random.Random(0)
+    values = [rng.lognormvariate(6, 1.5) for _ in range(10000)]
+    sketch = QuantileSketch(relative_accuracy=0.05)
+    for value in values:
+        sketch.add(value)
+
+    values.sort()
+    for q in (0.01, 0.1, 0.5, 0.9, 0.99):
+        exact = values[int(q * (len(values) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= 0.05 * exact
+    assert sketch.count == len(values)
+    assert len(sketch.bins) < 200
+
+
+def test_sketch_round_trip():
+    sketch = QuantileSketch()
+    for value in (0.5, 10, 100, 1000):
+        sketch.add(value)
+    restored = QuantileSketch.from_dict(sketch.to_dict())
+    assert restored.count == 4
+    assert restored.quantile(0.5) == sketch.quantile(0.5)
+
+
+def test_threshold_fallback_order():
+    calibrator = make_calibrator()
+    night, day = 30.0, 200.0
+    assert calibrator.threshold("cam1", night) == 500.0
+
+    label_many(calibrator, "cam1", night, [100, 120, 140], "blur")
+    label_many(calibrator, "cam1", night, [300, 320, 340], "sharp")
+    source_threshold = calibrator.threshold("cam1", night)
+    assert 140 < source_threshold < 300
+
+    # Other sources use the bucket-wide threshold, other buckets the default
+    label_many(calibrator, "cam2", night, [400, 420, 440], "blur")
+    label_many(calibrator, "cam2", night, [900, 950, 1000], "sharp")
+    assert calibrator.threshold("cam1", night) == source_threshold
+    assert calibrator.threshold("cam3", night) == calibrator.bucket_thresholds["night"]
+    assert calibrator.threshold("cam1", day) == 500.0
+
+
+def test_unlabelled_scores_do_not_move_threshold():
+    rng = random.Random(0)
+    calibrator = make_calibrator()
+    for _ in range(100):
+        calibrator.record("good", 200.0, rng.uniform(1000, 2000))
+        calibrator.record("bad", 200.0, rng.uniform(100, 200))
+    assert calibrator.threshold("good", 200.0) == 500.0
+    assert calibrator.threshold("bad", 200.0) == 500.0
+
+
+def test_threshold_rises_above_default():
+    calibrator = make_calibrator()
+    label_many(calibrator, "cam1", 200.0, [900, 950, 1000], "blur")
+    label_many(calibrator, "cam1", 200.0, [3000, 3100, 3200], "sharp")
+    assert 1000 < calibrator.threshold("cam1", 200.0) < 3000
+
+
+def test_threshold_clamped_to_band():
+    calibrator = make_calibrator()
+    label_many(calibrator, "high", 200.0, [5000, 5100, 5200], "blur")
+    label_many(calibrator, "high", 200.0, [9000, 9100, 9200], "sharp")
+    label_many(calibrator, "low", 200.0, [5, 6, 7], "blur")
+    label_many(calibrator, "low", 200.0, [20, 21, 22], "sharp")
+    assert calibrator.threshold("high", 200.0) == 2000.0
+    assert calibrator.threshold("low", 200.0) == 125.0
+
+
+def test_reject_quantile_cap_keeps_floor():
+    calibrator = make_calibrator(max_reject_quantile=0.1)
+    label_many(calibrator, "cam1", 200.0, [300, 300, 300], "blur")
+    label_many(calibrator, "cam1", 200.0, [2000, 2000, 2000], "sharp")
+    assert calibrator.threshold("cam1", 200.0) > 1000
+
+    for score in range(50, 80):
+        calibrator.record("cam1", 200.0, score)
+    calibrator.refresh()
+    assert calibrator.threshold("cam1", 200.0) == 125.0
+
+
+def test_record_refreshes_every_n_samples():
+    calibrator = make_calibrator(refresh_every=3)
+    assert calibrator.record("cam1", 30.0, 100) is False
+    assert calibrator.record("cam1", 30.0, 100) is False
+    assert calibrator.record("cam1", 30.0, 100) is True
+
+
+@pytest.mark.parametrize("source", ["*", "a|b", "", "../etc", "x" * 65])
+def test_invalid_source_rejected(source):
+    calibrator = make_calibrator()
+    with pytest.raises(ValueError):
+        calibrator.record(source, 30.0, 100)
+    assert calibrator.buckets == {}
+
+
+def test_invalid_label_rejected():
+    calibrator = make_calibrator()
+    with pytest.raises(ValueError):
+        calibrator.label("cam1", 30.0, 100, "described")
+
+
+def test_source_entries_capped():
+    calibrator = make_calibrator(max_sources=2)
+    for source in ("cam1", "cam2", "cam3", "cam4"):
+        calibrator.record(source, 30.0, 100)
+    assert set(calibrator.sources) == {"cam1", "cam2"}
+    assert calibrator.buckets["night"].scores.count == 4
+
+
+def test_stale_snapshot_not_written(tmp_path):
+    path = tmp_path / "calibration.json"
+    calibrator = make_calibrator(path=str(path))
+    old = calibrator.snapshot()
+    calibrator.record("cam1", 30.0, 100)
+    new = calibrator.snapshot()
+
+    calibrator.write(new)
+    calibrator.write(old)
+    assert json.loads(path.read_text())["version"] == new["version"]
+
+
+@pytest.mark.parametrize("content", ["[]", "not json", '{"buckets": {"night": {"scores": {"bins": {"x": 1}}}}}',
+                                     '{"buckets": {"night": []}}', '{"sources": {"cam1": null}}'])
+def test_corrupt_file_starts_empty(tmp_path, content):
+    path = tmp_path / "calibration.json"
+    path.write_text(content)
+    calibrator = make_calibrator(path=str(path))
+    assert calibrator.buckets == {}
+    assert calibrator.sources == {}
+    assert calibrator.threshold("cam1", 30.0) == 500.0
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "calibration.json")
+    calibrator = make_calibrator(path=path)
+    label_many(calibrator, "cam1", 30.0, [100, 120, 140], "blur")
+    label_many(calibrator, "cam1", 30.0, [300, 320, 340], "sharp")
+    calibrator.save()
+
+    restored = make_calibrator(path=path)
+    assert restored.threshold("cam1", 30.0) == calibrator.threshold("cam1", 30.0)
+    assert restored.stats() == calibrator.stats()
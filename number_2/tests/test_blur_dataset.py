@@ -0,0 +1,56 @@
+"""
+Rejection decisions on image_dataset before and after calibration.
+
+Labels come from looking at the images: Gambar6 and Gambar9 are motion
+blurred, Gambar4 is a sharp but noisy night shot that the default
+threshold rejects.
+"""
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("cv2")
+
+from app.blur_calibration import BlurCalibrator, brightness_bucket
+from app.blur_detector import is_blur, measure_image
+
+DATASET = Path(__file__).resolve().parent.parent / "image_dataset"
+BLURRY = {"Gambar6.jpg", "Gambar9.jpg"}
+DAYLIGHT = {"Gambar2.jpg", "Gambar3.jpg", "Gambar8.jpg"}
+
+
+@pytest.fixture(scope="module")
+def measured():
+    images = {path.name: path.read_bytes() for path in sorted(DATASET.glob("*.jpg"))}
+    return {name: (image_bytes, *measure_image(image_bytes)) for name, image_bytes in images.items()}
+
+
+def test_night_and_daylight_buckets(measured):
+    buckets = {name: brightness_bucket(brightness) for name, (_, _, brightness) in measured.items()}
+    assert {name for name, bucket in buckets.items() if bucket == "day"} == DAYLIGHT
+    assert buckets["Gambar1.jpg"] == buckets["Gambar10.jpg"] == "night"
+
+
+def test_rejections_before_and_after_calibration(measured):
+    calibrator = BlurCalibrator(path=None, min_labels=1)
+    for name, (_, variance, brightness) in measured.items():
+        calibrator.record("dataset", brightness, variance)
+        calibrator.label("dataset", brightness, variance, "blur" if name in BLURRY else "sharp")
+
+    before = {name for name, (image_bytes, _, _) in measured.items() if is_blur(image_bytes)[0]}
+    after = {
+        name for name, (_, variance, brightness) in measured.items()
+        if variance < calibrator.threshold("dataset", brightness)
+    }
+
+    assert before == BLURRY | {"Gambar4.jpg"}
+    assert after == BLURRY
+
+    # Night shots, including Gambar1 and Gambar10, get their own threshold;
+    # daylight has no blur labels and keeps the default
+    _, _, night_brightness = measured["Gambar1.jpg"]
+    _, _, day_brightness = measured["Gambar8.jpg"]
+    night_threshold = calibrator.threshold("dataset", night_brightness)
+    assert night_threshold == calibrator.threshold("dataset", measured["Gambar10.jpg"][2])
+    assert measured["Gambar6.jpg"][1] < night_threshold < measured["Gambar4.jpg"][1]
+    assert calibrator.threshold("dataset", day_brightness) == 500.0